@@ -1,9 +1,16 @@
 import argparse
+import concurrent.futures
+import contextlib
+import glob
+import hashlib
+import importlib.metadata
 import os
 import shutil
+import signal
 import subprocess
 import sys
-from typing import List
+import threading
+from typing import List, Optional
 
 THIS_DIR = os.path.abspath(os.path.dirname(__file__))
 DIST_DIR = os.path.join(THIS_DIR, "dist")
@@ -16,9 +23,23 @@ with open(os.path.join(THIS_DIR, ".px4-version"), "r") as fp:
 BUILD_DIR = os.path.join(THIS_DIR, "build", PX4_VERSION)
 PX4_DIR = os.path.join(BUILD_DIR, "PX4-Autopilot")
 
+# number of parallel git submodule fetches
+GIT_JOBS = os.cpu_count() or 4
 
-if PX4_VERSION < "v1.13.0":
+# PX4 v1.13.0 moved mavlink into a submodule that includes pymavlink
+IS_PRE_113 = PX4_VERSION < "v1.13.0"
+
+if IS_PRE_113:
     PYMAVLINK_DIR = os.path.join(BUILD_DIR, "pymavlink")
+    MESSAGE_DEFINITIONS_DIR = os.path.join(
+        PX4_DIR,
+        "mavlink",
+        "include",
+        "mavlink",
+        "v2.0",
+        "message_definitions",
+    )
+    GENERATED_MESSAGE_DIR = os.path.join(MESSAGE_DEFINITIONS_DIR, "..")
 else:
     PYMAVLINK_DIR = os.path.join(
         PX4_DIR,
@@ -28,6 +49,18 @@ else:
         "mavlink",
         "pymavlink",
     )
+    MESSAGE_DEFINITIONS_DIR = os.path.join(
+        PX4_DIR,
+        "src",
+        "modules",
+        "mavlink",
+        "mavlink",
+        "message_definitions",
+        "v1.0",
+    )
+    GENERATED_MESSAGE_DIR = os.path.join(MESSAGE_DEFINITIONS_DIR, "..", "..", "..")
+
+BELL_XML_DEF = os.path.join(MESSAGE_DEFINITIONS_DIR, "bell.xml")
 
 
 def print2(msg: str) -> None:
@@ -45,6 +78,33 @@ def touch_file(filename: str) -> None:
         pass
 
 
+def file_hash(filename: str) -> str:
+    """
+    Returns the SHA256 hash of a file's contents
+    """
+    with open(filename, "rb") as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+def link_file(src: str, dst: str) -> str:
+    """
+    Hardlink a file to a new location, falling back to a copy
+    if that is not possible (such as across filesystems).
+    Only use this for files that are not later rewritten in place.
+    """
+    # remove the destination first, otherwise an existing hardlink
+    # would be written through to the source
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+    return dst
+
+
 def clean_directory(directory: str, file_endings: List[str]) -> None:
     """
     Clean a directory of files with specific ends of the filenames
@@ -54,31 +114,141 @@ def clean_directory(directory: str, file_endings: List[str]) -> None:
     if not os.path.isdir(directory):
         return
 
-    for filename in os.listdir(directory):
-        if any(filename.endswith(e) for e in file_endings):
-            os.remove(os.path.join(directory, filename))
+    suffixes = tuple(file_endings)
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.endswith(suffixes):
+                os.remove(entry.path)
+
+
+def is_patch_applied(patch_file: str, directory: str) -> bool:
+    """
+    Check if a patch has already been applied to a git checkout,
+    by seeing if it can be cleanly reversed.
+    """
+    return (
+        subprocess.call(
+            [
+                "git",
+                "apply",
+                "--check",
+                "--reverse",
+                "--ignore-space-change",
+                "--ignore-whitespace",
+                patch_file,
+            ],
+            cwd=directory,
+            stderr=subprocess.DEVNULL,
+        )
+        == 0
+    )
+
+
+def acquire_build_lock() -> Optional[int]:
+    """
+    Take an exclusive lock on the build directory so that two builds
+    cannot run on top of each other. Exits if another build holds it.
+    The lock is held for as long as the returned file descriptor is open.
+    Returns None without locking where file locks are not available.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        # not available on Windows
+        return None
+
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    lock_file = os.path.join(BUILD_DIR, ".build.lock")
+
+    fd = os.open(lock_file, os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        pid = os.read(fd, 32).decode().strip()
+        os.close(fd)
+        print2(f"Another build (PID {pid or 'unknown'}) is already running")
+        sys.exit(1)
+
+    # record who holds the lock
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode())
+    return fd
 
 
 def clone_pymavlink() -> None:
     """
     Clone pymavlink.
     """
-    if PX4_VERSION >= "v1.13.0":
+    if not IS_PRE_113:
         return
 
     if os.path.isdir(PYMAVLINK_DIR):
+        # skip updating if the checkout already matches upstream
+        # output is "<sha>\tHEAD", or nothing if the remote has no HEAD
+        remote_heads = subprocess.check_output(
+            ["git", "ls-remote", "origin", "HEAD"], cwd=PYMAVLINK_DIR, text=True
+        ).split()
+        local_head = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=PYMAVLINK_DIR, text=True
+        ).strip()
+        if remote_heads and remote_heads[0] == local_head:
+            print2("pymavlink is up-to-date")
+            return
+
         # update the checkout if we already have it
         print2("Updating pymavlink")
-        subprocess.check_call(["git", "pull"], cwd=PYMAVLINK_DIR)
+        subprocess.check_call(
+            ["git", "fetch", "--depth", "1", "origin", "HEAD"], cwd=PYMAVLINK_DIR
+        )
+        subprocess.check_call(
+            ["git", "reset", "--hard", "FETCH_HEAD"], cwd=PYMAVLINK_DIR
+        )
+
+        # the reset discards the patch, so it needs to be applied again.
+        # clone_px4 may be removing this at the same time
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(BUILD_DIR, ".pymavlink-patched"))
 
     else:
         # clone fresh
         print2("Cloning pymavlink")
         subprocess.check_call(
-            ["git", "clone", "https://github.com/ardupilot/pymavlink", PYMAVLINK_DIR]
+            [
+                "git",
+                "clone",
+                "--depth",
+                "1",
+                "https://github.com/ardupilot/pymavlink",
+                PYMAVLINK_DIR,
+            ]
         )
 
 
+def checkout_px4_version() -> None:
+    """
+    Switch an existing PX4 checkout to PX4_VERSION in place.
+    """
+    subprocess.check_call(
+        ["git", "fetch", "--depth", "1", "origin", "tag", PX4_VERSION], cwd=PX4_DIR
+    )
+    subprocess.check_call(["git", "checkout", "--force", PX4_VERSION], cwd=PX4_DIR)
+    subprocess.check_call(
+        [
+            "git",
+            "submodule",
+            "update",
+            "--init",
+            "--recursive",
+            "--force",
+            "--depth",
+            "1",
+            "--jobs",
+            str(GIT_JOBS),
+        ],
+        cwd=PX4_DIR,
+    )
+
+
 def clone_px4() -> None:
     """
     Clone and patch PX4.
@@ -87,24 +257,53 @@ def clone_px4() -> None:
     # file to record if PX4 has been patched
     check_patch_file = os.path.join(BUILD_DIR, ".px4-patched")
 
+    # file to record what version of PX4 has been cloned
+    local_version_file = os.path.join(BUILD_DIR, ".px4-local-version")
+
     if os.path.isdir(PX4_DIR):
         # first, figure out what version we have locally
-        local_version = next(
-            l.split("/")[-1]
-            for l in subprocess.check_output(
-                ["git", "remote", "show", "origin", "-n"], cwd=PX4_DIR
-            )
-            .decode()
-            .splitlines()
-            if l.strip().startswith("refs")
-        )
-        # if version does not match, nuke it
+        if os.path.isfile(local_version_file):
+            with open(local_version_file, "r") as fp:
+                local_version = fp.read().strip()
+        else:
+            try:
+                # the clone is of a tag, which is still the nearest one
+                # even after the local commit
+                local_version = subprocess.check_output(
+                    ["git", "describe", "--tags", "--abbrev=0"], cwd=PX4_DIR, text=True
+                ).strip()
+            except subprocess.CalledProcessError:
+                local_version = subprocess.check_output(
+                    ["git", "rev-parse", "--abbrev-ref", "HEAD"], cwd=PX4_DIR, text=True
+                ).strip()
+
+            # record it so git doesn't need to be asked next time
+            if local_version == PX4_VERSION:
+                with open(local_version_file, "w") as fp:
+                    fp.write(PX4_VERSION)
+
+        # if version does not match, switch the existing checkout over
         if local_version != PX4_VERSION:
-            print(f"Existing PX4 checkout is {local_version}, re-cloning")
-            shutil.rmtree(BUILD_DIR)
-            clone_px4()
-
-    else:
+            print2(f"Existing PX4 checkout is {local_version}, switching")
+            try:
+                checkout_px4_version()
+            except subprocess.CalledProcessError:
+                # if that fails, nuke it
+                print2("Switching failed, re-cloning")
+                shutil.rmtree(PX4_DIR)
+            else:
+                # record what version is now checked out
+                with open(local_version_file, "w") as fp:
+                    fp.write(PX4_VERSION)
+
+            # the new checkout needs to be patched and committed again
+            for pattern in (".px4-patched", ".pymavlink-patched", ".mavlink-commited*"):
+                for filename in glob.glob(os.path.join(BUILD_DIR, pattern)):
+                    # clone_pymavlink may be removing these at the same time
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(filename)
+
+    if not os.path.isdir(PX4_DIR):
         # clone fresh
         print2("Cloning PX4")
         subprocess.check_call(
@@ -115,86 +314,205 @@ def clone_px4() -> None:
                 PX4_DIR,
                 "--depth",
                 "1",
+                "--single-branch",
+                "--no-tags",
                 "--branch",
                 PX4_VERSION,
-                "--recurse-submodules",
             ]
         )
-
-    if not os.path.isfile(check_patch_file):
-        print2("Applying PX4 patch")
+        # fetch the submodules separately so they are fetched in parallel
         subprocess.check_call(
             [
                 "git",
-                "apply",
-                "--ignore-space-change",
-                "--ignore-whitespace",
-                os.path.join(
-                    THIS_DIR, "patches", f"hil_gps_heading_{PX4_VERSION}.patch"
-                ),
+                "submodule",
+                "update",
+                "--init",
+                "--recursive",
+                "--depth",
+                "1",
+                "--jobs",
+                str(GIT_JOBS),
             ],
             cwd=PX4_DIR,
         )
+        # make any later submodule updates run in parallel as well
+        subprocess.check_call(
+            ["git", "config", "submodule.fetchJobs", str(GIT_JOBS)], cwd=PX4_DIR
+        )
+
+        # record what version was cloned
+        with open(local_version_file, "w") as fp:
+            fp.write(PX4_VERSION)
+
+    if not os.path.isfile(check_patch_file):
+        patch_file = os.path.join(
+            THIS_DIR, "patches", f"hil_gps_heading_{PX4_VERSION}.patch"
+        )
+        if is_patch_applied(patch_file, PX4_DIR):
+            print2("PX4 patch already applied")
+        else:
+            print2("Applying PX4 patch")
+            subprocess.check_call(
+                [
+                    "git",
+                    "apply",
+                    "--ignore-space-change",
+                    "--ignore-whitespace",
+                    patch_file,
+                ],
+                cwd=PX4_DIR,
+            )
 
         # record that it has been patched
         touch_file(check_patch_file)
 
 
+def requirements_satisfied(requirements_file: str) -> bool:
+    """
+    Check if wheel and everything in a requirements file are already
+    installed in this Python environment.
+    """
+    try:
+        from packaging.requirements import InvalidRequirement, Requirement
+    except ImportError:
+        # can't tell, so assume not
+        return False
+
+    with open(requirements_file, "r") as fp:
+        lines = ["wheel"] + [line.split("#")[0].strip() for line in fp]
+
+    for line in lines:
+        if not line:
+            continue
+
+        try:
+            requirement = Requirement(line)
+        except InvalidRequirement:
+            # pip options and the like, leave those to pip
+            return False
+
+        if requirement.marker is not None and not requirement.marker.evaluate():
+            continue
+
+        try:
+            installed_version = importlib.metadata.version(requirement.name)
+        except importlib.metadata.PackageNotFoundError:
+            return False
+
+        if not requirement.specifier.contains(installed_version, prereleases=True):
+            return False
+
+    return True
+
+
 def install_dependencies() -> None:
     """
     Install any needed dependencies
     """
+    requirements_file = os.path.join(PYMAVLINK_DIR, "requirements.txt")
+
+    if requirements_satisfied(requirements_file):
+        print2("Python dependencies already installed")
+        return
+
     print2("Installing Python dependencies")
-    subprocess.check_call(
-        [sys.executable, "-m", "pip", "install", "--upgrade", "pip", "wheel"]
-    )
-    subprocess.check_call(
-        [
-            sys.executable,
-            "-m",
-            "pip",
-            "install",
-            "-r",
-            os.path.join(PYMAVLINK_DIR, "requirements.txt"),
-        ]
-    )
+    pip_args = [
+        sys.executable,
+        "-m",
+        "pip",
+        "install",
+        "--no-input",
+        "--disable-pip-version-check",
+    ]
+    subprocess.check_call(pip_args + ["--upgrade", "pip", "wheel"])
+    subprocess.check_call(pip_args + ["-r", requirements_file])
+
+
+def run_mavgen(language: str, output: str) -> None:
+    """
+    Generate code for the Bell MAVLink message with mavgen from our pymavlink
+    checkout. Runs in-process when possible to avoid starting a new interpreter.
+    """
+    pymavlink_parent_dir = os.path.abspath(os.path.join(PYMAVLINK_DIR, ".."))
 
+    try:
+        # make sure our checkout is imported, the same as running from its parent
+        if pymavlink_parent_dir not in sys.path:
+            sys.path.insert(0, pymavlink_parent_dir)
 
-def build_pymavlink(
-    message_definitions_dir: str, bell_xml_def: str, should_build_wireshark: bool
-) -> None:
+        from pymavlink.generator import mavgen
+    except ImportError:
+        subprocess.check_call(
+            [
+                sys.executable,
+                "-m",
+                "pymavlink.tools.mavgen",
+                f"--lang={language}",
+                "--wire-protocol=2.0",
+                f"--output={output}",
+                BELL_XML_DEF,
+            ],
+            cwd=pymavlink_parent_dir,
+        )
+        return
+
+    opts = mavgen.Opts(output, wire_protocol="2.0", language=language)
+    if not mavgen.mavgen(opts, [BELL_XML_DEF]):
+        raise RuntimeError(f"mavgen failed to generate {language} code")
+
+
+def build_pymavlink(should_build_wireshark: bool) -> None:
     print2("Generating pymavlink package")
 
     # file to record if Pymavlink has been patched
     check_patch_file = os.path.join(BUILD_DIR, ".pymavlink-patched")
 
     if not os.path.isfile(check_patch_file):
-        print2("Applying Pymavlink patch")
-        subprocess.check_call(["git", "reset", "--hard"], cwd=PYMAVLINK_DIR)
-        subprocess.check_call(
-            [
-                "git",
-                "apply",
-                "--ignore-space-change",
-                "--ignore-whitespace",
-                os.path.join(THIS_DIR, "patches", f"pymavlink_{PX4_VERSION}.patch"),
-            ],
-            cwd=PYMAVLINK_DIR,
-        )
+        patch_file = os.path.join(THIS_DIR, "patches", f"pymavlink_{PX4_VERSION}.patch")
+        if is_patch_applied(patch_file, PYMAVLINK_DIR):
+            print2("Pymavlink patch already applied")
+        else:
+            print2("Applying Pymavlink patch")
+            subprocess.check_call(["git", "reset", "--hard"], cwd=PYMAVLINK_DIR)
+            subprocess.check_call(
+                [
+                    "git",
+                    "apply",
+                    "--ignore-space-change",
+                    "--ignore-whitespace",
+                    patch_file,
+                ],
+                cwd=PYMAVLINK_DIR,
+            )
         # record that it has been patched
         touch_file(check_patch_file)
 
-    # copy message definitions from px4 so we're using the exact same version
-    print2("Copying message definitions")
-    shutil.rmtree(
-        os.path.join(PYMAVLINK_DIR, "message_definitions", "v1.0"),
-        ignore_errors=True,
-    )
-    shutil.copytree(
-        message_definitions_dir,
-        os.path.join(PYMAVLINK_DIR, "message_definitions", "v1.0"),
+    # link message definitions from px4 so we're using the exact same version
+    print2("Linking message definitions")
+    pymavlink_message_definitions_dir = os.path.join(
+        PYMAVLINK_DIR, "message_definitions", "v1.0"
     )
 
+    if os.path.islink(pymavlink_message_definitions_dir):
+        os.remove(pymavlink_message_definitions_dir)
+    else:
+        shutil.rmtree(pymavlink_message_definitions_dir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(pymavlink_message_definitions_dir), exist_ok=True)
+    try:
+        os.symlink(
+            MESSAGE_DEFINITIONS_DIR,
+            pymavlink_message_definitions_dir,
+            target_is_directory=True,
+        )
+    except OSError:
+        # symlinks may not be allowed (such as on Windows), so hardlink the files
+        shutil.copytree(
+            MESSAGE_DEFINITIONS_DIR,
+            pymavlink_message_definitions_dir,
+            copy_function=link_file,
+        )
+
     pymavlink_dist_dir = os.path.join(PYMAVLINK_DIR, "dist")
 
     # clean the pymavlink build and target dirs
@@ -217,8 +535,10 @@ def build_pymavlink(
         env=new_env,
     )
 
-    # copy the outputs to the target directory
+    # copy the outputs to the target directory.
+    # both are needed, as dist/ is published to PyPI
     for filename in os.listdir(pymavlink_dist_dir):
+        # copied rather than linked, as later builds overwrite the source
         shutil.copyfile(
             os.path.join(pymavlink_dist_dir, filename),
             os.path.join(DIST_DIR, filename),
@@ -228,35 +548,96 @@ def build_pymavlink(
     # https://mavlink.io/en/guide/wireshark.html
     if should_build_wireshark:
         print2("Building wireshark plugin")
-        subprocess.check_call(
-            [
-                sys.executable,
-                "-m",
-                "pymavlink.tools.mavgen",
-                "--lang=WLua",
-                "--wire-protocol=2.0",
-                f"--output={os.path.join(DIST_DIR, 'bell-avr.lua')}",
-                bell_xml_def,
-            ],
-            cwd=os.path.join(PYMAVLINK_DIR, ".."),
-        )
+        run_mavgen("WLua", os.path.join(DIST_DIR, "bell-avr.lua"))
 
 
-def build_px4(targets: List[str], version: str) -> None:
-    print2("Building PX4 firmware")
+def stop_process_group(proc: subprocess.Popen) -> None:
+    """
+    Stop a process started with start_new_session, along with its children.
+    Falls back to stopping just the process where process groups
+    are not available (such as on Windows).
+    """
+    with contextlib.suppress(ProcessLookupError):
+        if hasattr(os, "killpg"):
+            os.killpg(proc.pid, signal.SIGTERM)
+        else:
+            proc.terminate()
+
 
+def build_px4_target(
+    target: str,
+    version: str,
+    jobs: int,
+    processes: List[subprocess.Popen],
+    stop: threading.Event,
+) -> None:
+    """
+    Build a single PX4 target and copy the firmware to the target directory.
+    Output is prefixed with the target name so parallel builds can be told apart.
+    """
     px4_build_dir = os.path.join(PX4_DIR, "build")
 
+    # run in a new session so the whole build can be stopped together
+    with subprocess.Popen(
+        ["make", target, f"-j{jobs}"],
+        cwd=PX4_DIR,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+        start_new_session=True,
+    ) as proc:
+        processes.append(proc)
+        if stop.is_set():
+            # another target failed before this one started
+            stop_process_group(proc)
+
+        for line in proc.stdout:
+            print(f"[{target}] {line}", end="", flush=True)
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    # copied rather than linked, as later builds overwrite the source in place
+    shutil.copyfile(
+        os.path.join(px4_build_dir, target, f"{target}.px4"),
+        os.path.join(DIST_DIR, f"{target}.{PX4_VERSION}.{version}.px4"),
+    )
+
+
+def build_px4(targets: List[str], version: str) -> None:
+    print2("Building PX4 firmware")
+
     # clean the PX4 build and target dir
     # clean_directory(px4_build_dir, [".px4"])
     # clean_directory(DIST_DIR, [".px4"])
 
-    for target in targets:
-        subprocess.check_call(["make", target, "-j"], cwd=PX4_DIR)
-        shutil.copyfile(
-            os.path.join(px4_build_dir, target, f"{target}.px4"),
-            os.path.join(DIST_DIR, f"{target}.{PX4_VERSION}.{version}.px4"),
+    # build all targets at once, splitting the cores between them
+    # so the total number of jobs does not oversubscribe the machine
+    jobs = max(1, (os.cpu_count() or 1) // len(targets))
+    processes: List[subprocess.Popen] = []
+    stop = threading.Event()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = [
+            executor.submit(build_px4_target, target, version, jobs, processes, stop)
+            for target in targets
+        ]
+        done, _ = concurrent.futures.wait(
+            futures, return_when=concurrent.futures.FIRST_EXCEPTION
         )
+        failed = [future for future in futures if future in done and future.exception()]
+
+        if failed:
+            # no point finishing the other targets, stop them
+            print2("PX4 build failed, stopping other targets")
+            stop.set()
+            for proc in processes:
+                if proc.poll() is None:
+                    stop_process_group(proc)
+
+    if failed:
+        # re-raise the first failure
+        failed[0].result()
 
 
 def main(
@@ -266,91 +647,73 @@ def main(
     version: str,
     targets: List[str],
 ) -> None:
-    os.makedirs(DIST_DIR, exist_ok=True)
+    # lock is held until the process exits
+    acquire_build_lock()
 
-    # clone pymavlink if necessary
-    clone_pymavlink()
+    os.makedirs(DIST_DIR, exist_ok=True)
 
-    # get px4 cloned
-    clone_px4()
+    if IS_PRE_113:
+        # pymavlink and px4 come from independent remotes,
+        # so clone both at the same time
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(clone_pymavlink), executor.submit(clone_px4)]
+            for future in futures:
+                # re-raise any exceptions
+                future.result()
+    else:
+        # get px4 cloned, pymavlink comes with it
+        clone_px4()
 
     # install python dependencies for pymavlink
     install_dependencies()
 
-    # build directory paths
-    if PX4_VERSION < "v1.13.0":
-        message_definitions_dir = os.path.join(
-            PX4_DIR,
-            "mavlink",
-            "include",
-            "mavlink",
-            "v2.0",
-            "message_definitions",
-        )
-        generated_message_dir = os.path.join(message_definitions_dir, "..")
-    else:
-        message_definitions_dir = os.path.join(
-            PX4_DIR,
-            "src",
-            "modules",
-            "mavlink",
-            "mavlink",
-            "message_definitions",
-            "v1.0",
-        )
-        generated_message_dir = os.path.join(message_definitions_dir, "..", "..", "..")
-
-    bell_xml_def = os.path.join(message_definitions_dir, "bell.xml")
-
-    # file to record if mavlink has been committed
-    check_patch_file = os.path.join(BUILD_DIR, ".mavlink-commited")
+    # file to record if this exact mavlink message has been generated
+    # and committed
+    bell_xml_file = os.path.join(THIS_DIR, "bell.xml")
+    check_patch_file = os.path.join(
+        BUILD_DIR, f".mavlink-commited-{file_hash(bell_xml_file)}"
+    )
 
     if not os.path.isfile(check_patch_file):
         print2("Injecting Bell MAVLink message")
-        shutil.copyfile(os.path.join(THIS_DIR, "bell.xml"), bell_xml_def)
+        shutil.copyfile(bell_xml_file, BELL_XML_DEF)
 
         # generate the mavlink C code
-        if PX4_VERSION < "v1.13.0":
+        if IS_PRE_113:
+            run_mavgen("C", GENERATED_MESSAGE_DIR)
+
+        # changes need to be committed to build.
+        # git config does not matter, just need *something* to commit,
+        # they're not pushed anywhere
+        subprocess.check_call(["git", "add", "."], cwd=PX4_DIR)
+
+        # skip the commit if nothing changed, such as the message
+        # already being committed
+        if subprocess.call(["git", "diff", "--cached", "--quiet"], cwd=PX4_DIR) != 0:
             subprocess.check_call(
                 [
-                    sys.executable,
+                    "git",
+                    "-c",
+                    "user.email=github-bot@nvaughn.email",
+                    "-c",
+                    "user.name=Github Actions",
+                    "commit",
+                    "--no-gpg-sign",
                     "-m",
-                    "pymavlink.tools.mavgen",
-                    "--lang=C",
-                    "--wire-protocol=2.0",
-                    f"--output={generated_message_dir}",
-                    bell_xml_def,
+                    "Local commit to facilitate build",
                 ],
-                cwd=os.path.join(PYMAVLINK_DIR, ".."),
+                cwd=PX4_DIR,
             )
 
-        # git config does not matter, just need *something* to commit,
-        # they're not pushed anywhere
-        subprocess.check_call(
-            ["git", "config", "user.email", "github-bot@nvaughn.email"], cwd=PX4_DIR
-        )
-        subprocess.check_call(
-            ["git", "config", "user.name", "Github Actions"], cwd=PX4_DIR
-        )
-
-        # changes need to be committed to build
-        subprocess.check_call(["git", "add", "."], cwd=PX4_DIR)
-        subprocess.check_call(
-            [
-                "git",
-                "commit",
-                "--no-gpg-sign",
-                "-m",
-                "Local commit to facilitate build",
-            ],
-            cwd=PX4_DIR,
-        )
-
-        # record that it has been committed
+        # record that it has been committed, replacing the record for
+        # any previous version of the message (including the unhashed
+        # record from older build directories)
+        for filename in glob.glob(os.path.join(BUILD_DIR, ".mavlink-commited*")):
+            os.remove(filename)
         touch_file(check_patch_file)
 
     if should_build_pymavlink:
-        build_pymavlink(message_definitions_dir, bell_xml_def, should_build_wireshark)
+        build_pymavlink(should_build_wireshark)
 
     if should_build_px4:
         build_px4(targets, version)
@@ -362,10 +725,8 @@ if __name__ == "__main__":
         "--version",
         type=str,
         default=subprocess.check_output(
-            ["git", "rev-parse", "--short", "HEAD"], cwd=THIS_DIR
-        )
-        .decode("utf-8")
-        .strip(),
+            ["git", "rev-parse", "--short", "HEAD"], cwd=THIS_DIR, text=True
+        ).strip(),
     )
     parser.add_argument(
         "--pymavlink", action="store_true", help="Build Pymavlink package"